@@ -1,5 +1,8 @@
 import re
+import weakref
+from dataclasses import fields
 from itertools import islice
+from sys import intern
 
 import pytest
 
@@ -8,6 +11,7 @@ from tokenstream import (
     SourceLocation,
     Token,
     TokenStream,
+    UnexpectedEOF,
     UnexpectedToken,
 )
 
@@ -47,6 +51,18 @@ def test_expect_fail():
             stream.expect("number").value
 
 
+def test_interned_token_type():
+    stream = TokenStream("hello world")
+
+    with stream.syntax(word=r"\w+"):
+        assert stream.expect().type is intern("word")
+
+    token_type = "".join(["comm", "ent"])
+
+    with stream.ignore(token_type):
+        assert all(name is intern(name) for name in stream.ignored_tokens)
+
+
 def test_peek():
     stream = TokenStream("hello world")
 
@@ -72,6 +88,17 @@ def test_peek_backwards():
         assert first is stream.peek(-1)
 
 
+def test_peek_past_end():
+    stream = TokenStream("hello world 123")
+
+    with stream.syntax(word=r"[a-z]+", number=r"[0-9]+"):
+        assert stream.expect("word").value == "hello"
+        assert stream.peek(5) is None
+
+    with stream.syntax(word=r"[a-z]+", number=r"[0-9]+"):
+        assert [token.value for token in stream] == ["world", "123"]
+
+
 def test_reject_whitespace():
     stream = TokenStream("hello world")
 
@@ -159,6 +186,75 @@ def test_indent_whitespace():
         stream.expect("word")
 
 
+def test_indent_crop():
+    stream = TokenStream("a\n  b\nc")
+
+    with stream.syntax(word=r"\w+"), stream.indent():
+        stream.expect("word")
+        stream.expect("indent")
+
+        with stream.syntax(number=r"\d+"):
+            stream.peek(3)
+
+        assert [token.type for token in stream.collect()] == [
+            "word",
+            "dedent",
+            "word",
+        ]
+
+    stream = TokenStream("a\n  b\nc")
+
+    with stream.syntax(word=r"\w+"), stream.indent():
+        stream.expect("word")
+
+        with stream.checkpoint():
+            stream.expect("indent")
+            stream.expect("word")
+            stream.expect("dedent")
+            stream_copy = stream.copy()
+            stream.expect("number")
+
+        with stream.syntax(letter=r"[a-z]"):
+            assert [token.type for token in stream.collect()] == [
+                "indent",
+                "letter",
+                "dedent",
+                "letter",
+            ]
+
+        assert [token.type for token in stream_copy.collect()] == ["word"]
+
+    stream = TokenStream("a\n  b\n    c\nd")
+
+    with stream.syntax(word=r"\w+"), stream.indent():
+        for token_type in ["word", "indent", "word", "indent", "word", "dedent"]:
+            stream.expect(token_type)
+
+        stream.peek()
+
+        with stream.syntax(number=r"\d+"):
+            pass
+
+        assert [token.type for token in stream.collect()] == ["dedent", "word"]
+
+    stream = TokenStream("  a\n b")
+
+    with stream.syntax(word=r"\w+"), stream.indent():
+        for token_type in ["indent", "word", "dedent"]:
+            stream.expect(token_type)
+
+        stream.peek()
+
+        with stream.syntax(number=r"\d+"):
+            pass
+
+        assert [token.type for token in stream.collect()] == [
+            "indent",
+            "word",
+            "dedent",
+        ]
+
+
 def test_indent_tricky():
     stream = TokenStream(
         "hello\n"
@@ -210,6 +306,39 @@ def test_checkpoint_commit():
         assert [token.value for token in stream] == []
 
 
+def test_checkpoint_other_exception():
+    stream = TokenStream("hello world")
+
+    with stream.syntax(word=r"\w+"):
+        with pytest.raises(ValueError):
+            with stream.checkpoint():
+                stream.expect("word")
+                raise ValueError()
+
+        with pytest.raises(UnexpectedToken):
+            with stream.checkpoint() as commit:
+                stream.expect("word")
+                commit()
+                stream.expect("number")
+
+        assert stream.expect("word").value == "world"
+
+
+def test_alternative_other_exception():
+    stream = TokenStream("hello world")
+
+    with stream.syntax(word=r"\w+"):
+        with pytest.raises(ValueError):
+            with stream.alternative():
+                stream.expect("word")
+                raise ValueError()
+
+        with stream.alternative():
+            stream.expect("word")
+
+        assert stream.expect("word").value == "world"
+
+
 def test_checkpoint_error():
     stream = TokenStream("hello world 1 2 3 thing")
 
@@ -302,6 +431,65 @@ def test_choose_append():
     assert result == ["hello", "world", (1, 2, 3), "thing"]
 
 
+def test_choose_error():
+    stream = TokenStream("hello world 1 2 thing")
+
+    def triplet(stream: TokenStream) -> tuple[int, int, int]:
+        return (
+            int(stream.expect("number").value),
+            int(stream.expect("number").value),
+            int(stream.expect("number").value),
+        )
+
+    def pair(stream: TokenStream) -> tuple[str, str]:
+        return stream.expect("word").value, stream.expect("number").value
+
+    with stream.syntax(number=r"\d+", word=r"\w+"):
+        stream.expect("word")
+        stream.expect("word")
+
+        with pytest.raises(
+            UnexpectedToken, match="Expected number but got word 'thing'"
+        ):
+            for parser, alternative in stream.choose(triplet, pair):
+                with alternative:
+                    parser(stream)
+
+
+def test_choose_lazy_error_message(monkeypatch: pytest.MonkeyPatch):
+    calls: list[object] = []
+    monkeypatch.setattr("tokenstream.error.explain_patterns", calls.append)
+
+    stream = TokenStream("1 2 3")
+
+    with stream.syntax(number=r"\d+", word=r"\w+"):
+        for _ in stream.peek_until():
+            for token_type, alternative in stream.choose("word", "number"):
+                with alternative:
+                    stream.expect(token_type)
+
+    assert not calls
+
+
+def test_list_patterns():
+    stream = TokenStream("hello world")
+
+    with stream.syntax(number=r"\d+", word=r"\w+"):
+        number, word = stream.expect("number", ["word", "hello"])  # type: ignore
+        assert number is None
+        assert word and word.value == "hello"
+
+        assert stream.get("number", ["word", "world"])  # type: ignore
+        assert stream.get(["word", "world"]) is None  # type: ignore
+
+        with pytest.raises(UnexpectedEOF) as exc_info:
+            stream.expect("number", ["word", "hello"])  # type: ignore
+
+        assert str(exc_info.value) == (
+            "Expected number or word 'hello' but reached end of file."
+        )
+
+
 def test_get():
     stream = TokenStream("hello world 1 2 3 thing")
 
@@ -317,6 +505,32 @@ def test_get():
     assert result == [777, 1, 2, 3]
 
 
+def test_any():
+    stream = TokenStream("hello 1 world 2 ;")
+
+    with stream.syntax(number=r"\d+", word=r"\w+", semi=r";"):
+        assert stream.expect_any("number", "word").value == "hello"
+        assert [token.value for token in stream.collect_any("word", "number")] == [
+            "1",
+            "world",
+            "2",
+        ]
+
+        with pytest.raises(
+            UnexpectedToken, match="Expected number or word but got semi ';'"
+        ):
+            stream.expect_any("number", "word")
+
+        assert stream.expect_any("semi", ("word", "foo")).value == ";"
+
+    stream = TokenStream("hello world")
+
+    with stream.syntax(word=r"\w+"):
+        patterns = ["word", "hello"], ["word", "world"]
+        tokens = list(stream.collect_any(*patterns))  # type: ignore
+        assert [token.value for token in tokens] == ["hello", "world"]
+
+
 def test_eof():
     stream = TokenStream("hello world")
 
@@ -332,6 +546,158 @@ def test_eof():
     stream.expect_eof()
 
 
+def test_regex_cache():
+    stream = TokenStream("hello world")
+
+    with stream.syntax(word=r"\w+"):
+        regex = stream.regex
+        syntax_rules = stream.syntax_rules
+
+        with stream.intercept("eof"), stream.ignore("word"):
+            assert stream.regex is regex
+            stream.expect_eof()
+
+    stream_copy = stream.copy()
+
+    with stream_copy.syntax(word=r"\w+"):
+        assert stream_copy.regex is regex
+        assert stream_copy.syntax_rules is syntax_rules
+
+
+def test_syntax_rules_merge():
+    stream = TokenStream("hello world")
+    merged: list[object] = []
+
+    for _ in range(2):
+        with stream.syntax(word=r"\w+", number=r"\d+"):
+            with stream.syntax(letter=r"[a-z]", number=None):
+                assert stream.syntax_rules == (
+                    ("letter", "[a-z]"),
+                    ("word", r"\w+"),
+                )
+                merged.append(stream.syntax_rules)
+
+    assert merged[0] is merged[1]
+
+
+def test_precompile():
+    TokenStream.precompile((("letter", r"[a-z]"),))
+    regex = TokenStream("").regex_cache[(("letter", r"[a-z]"),)]
+
+    stream = TokenStream("hello")
+
+    with stream.syntax(letter=r"[a-z]"):
+        assert stream.regex is regex
+
+
+def test_regex_cache_size(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr("tokenstream.stream.REGEX_CACHE_SIZE", 2)
+    stream = TokenStream("hello world")
+
+    for i in range(5):
+        with stream.syntax(**{f"word{i}": r"\w+"}):
+            assert stream.peek().type == f"word{i}"  # type: ignore
+
+    assert len(stream.regex_cache) <= 2
+
+
+def test_regex_module_without_multiline():
+    class RegexModule:
+        compile = staticmethod(re.compile)
+
+    stream = TokenStream("a\nb", regex_module=RegexModule)
+
+    with stream.syntax(start=r"^\w"):
+        assert [token.value for token in stream] == ["a", "b"]
+
+
+def test_intern_empty_syntax_rules(monkeypatch: pytest.MonkeyPatch):
+    rules = (("word", r"\w+"),)
+    interned = {rules: rules, (): ()}
+    monkeypatch.setattr("tokenstream.stream.SYNTAX_RULES_INTERN", interned)
+    monkeypatch.setattr("tokenstream.stream.SYNTAX_RULES_CACHE_SIZE", 2)
+
+    stream = TokenStream("hello world")
+
+    with stream.reset_syntax():
+        assert stream.syntax_rules == ()
+
+    assert interned == {rules: rules, (): ()}
+
+
+def test_copy():
+    stream = TokenStream("hello world 123")
+
+    with stream.syntax(word=r"\w+"):
+        stream.expect("word")
+        stream.peek(2)
+        stream_copy = stream.copy()
+        assert stream_copy.tokens is stream.tokens
+
+        for attribute in fields(TokenStream):
+            assert hasattr(stream_copy, attribute.name)
+
+        with stream_copy.syntax(letter=r"[a-z]"):
+            assert stream_copy.expect("letter").value == "w"
+
+        assert stream_copy.tokens is not stream.tokens
+        assert [token.value for token in stream] == ["world", "123"]
+        assert [token.value for token in stream_copy] == ["orld", "123"]
+
+
+def test_weakref():
+    stream = TokenStream("hello world")
+    assert weakref.ref(stream)() is stream
+    stream_copy = stream.copy()
+    assert weakref.ref(stream_copy)() is stream_copy
+
+
+def test_provide():
+    stream = TokenStream("hello world")
+
+    with stream.provide(foo=1):
+        with stream.provide(foo=2, bar=3):
+            assert stream.data == {"foo": 2, "bar": 3}
+            with stream.reset("foo", "thing"):
+                assert stream.data == {"bar": 3}
+            assert stream.data == {"foo": 2, "bar": 3}
+        assert stream.data == {"foo": 1}
+
+    assert stream.data == {}
+
+
+def test_context_managers_apply_on_enter():
+    stream = TokenStream("hello world")
+
+    syntax = stream.syntax(word=r"\w+")
+    ignore = stream.ignore("word")
+    provide = stream.provide(foo=1)
+
+    assert stream.syntax_rules == ()
+    assert "word" not in stream.ignored_tokens
+    assert stream.data == {}
+
+    with syntax, ignore, provide as provided:
+        assert provided is stream
+        assert stream.syntax_rules == (("word", r"\w+"),)
+        assert stream.peek() is None
+
+    assert stream.syntax_rules == ()
+
+
+def test_context_managers_reenter():
+    stream = TokenStream("hello world")
+    syntax = stream.syntax(x="a")
+
+    with stream.syntax(y="b"), syntax:
+        assert stream.syntax_rules == (("x", "a"), ("y", "b"))
+
+    with stream.syntax(y="[ab]"), syntax:
+        assert stream.syntax_rules == (("x", "a"), ("y", "[ab]"))
+
+    assert stream.syntax_rules == ()
+
+
 WRAP_REGEX = re.compile(r"(\\[ \t]*\r?\n[ \t]*)")
 
 
@@ -405,3 +771,16 @@ def test_wrap_line():
                 end_location=SourceLocation(pos=74, lineno=8, colno=12),
             ),
         ]
+
+
+def test_wrap_line_crop():
+    stream = TokenStream("hel\\\nlo world", preprocessor=wrap_lines)
+
+    with stream.syntax(word=r"\w+"):
+        assert stream.expect("word").value == "hello"
+        stream.peek()
+
+    with stream.syntax(letter=r"\w"):
+        token = stream.expect("letter")
+        assert token.value == "w"
+        assert token.location == SourceLocation(pos=8, lineno=2, colno=4)
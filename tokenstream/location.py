@@ -54,12 +54,13 @@ class SourceLocation(NamedTuple):
         >>> INITIAL_LOCATION.skip_over("hello\\nworld")
         SourceLocation(pos=11, lineno=2, colno=6)
         """
+        size = len(value)
+        if (line_start := value.rfind("\n")) == -1:
+            return SourceLocation(self.pos + size, self.lineno, self.colno + size)
         return SourceLocation(
-            self.pos + len(value),
+            self.pos + size,
             self.lineno + value.count("\n"),
-            self.colno + len(value)
-            if (line_start := value.rfind("\n")) == -1
-            else len(value) - line_start,
+            size - line_start,
         )
 
     def map(
@@ -4,17 +4,21 @@ __all__ = [
     "Preprocessor",
     "CheckpointCommit",
     "BAKED_REGEX_CACHE",
+    "REGEX_CACHE_SIZE",
 ]
 
 import re
-from contextlib import contextmanager
 from dataclasses import dataclass, field
+from functools import lru_cache
+from sys import intern
+from types import TracebackType
 from typing import (
     Any,
     Callable,
     ContextManager,
     Iterable,
     Iterator,
+    Mapping,
     Sequence,
     TypeVar,
     overload,
@@ -22,7 +26,7 @@ from typing import (
 
 from .error import InvalidSyntax, UnexpectedEOF, UnexpectedToken
 from .location import INITIAL_LOCATION, SourceLocation, set_location
-from .token import Token, TokenPattern
+from .token import Token, TokenPattern, compile_patterns, compile_predicate
 
 T = TypeVar("T")
 
@@ -38,7 +42,7 @@ def extra_field(**kwargs: Any) -> Any:
     return field(repr=False, init=False, hash=False, compare=False, **kwargs)
 
 
-@dataclass
+@dataclass(slots=True)
 class CheckpointCommit:
     """Handle for managing checkpoints.
 
@@ -59,11 +63,340 @@ class CheckpointCommit:
         self.rollback = False
 
 
+@dataclass(slots=True)
+class Checkpoint:
+    """Context manager returned by :meth:`TokenStream.checkpoint`.
+
+    Should be considered internal.
+    """
+
+    stream: "TokenStream"
+    commit: CheckpointCommit = field(init=False)
+
+    def __enter__(self) -> CheckpointCommit:
+        self.commit = CheckpointCommit(self.stream.index)
+        return self.commit
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> bool:
+        if not self.commit.rollback:
+            return False
+        self.stream.index = self.commit.index
+        return isinstance(exc_value, InvalidSyntax)
+
+
+@dataclass(slots=True)
+class Alternative:
+    """Context manager returned by :meth:`TokenStream.alternative`.
+
+    Should be considered internal.
+    """
+
+    stream: "TokenStream"
+    active: bool = True
+    index: int = -1
+
+    def __enter__(self) -> None:
+        self.index = self.stream.index
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> bool:
+        if exc_type is None or not self.active:
+            return False
+        self.stream.index = self.index
+        return isinstance(exc_value, InvalidSyntax)
+
+
+@dataclass(slots=True)
+class ChooseState:
+    """State shared by the alternatives produced by :meth:`TokenStream.choose`.
+
+    Should be considered internal.
+    """
+
+    stream: "TokenStream"
+    should_break: bool = False
+    exception: InvalidSyntax | None = None
+
+
+@dataclass(slots=True)
+class ChooseAlternative:
+    """Context manager for a single alternative produced by :meth:`TokenStream.choose`.
+
+    Works like :meth:`TokenStream.alternative` but records the syntax error
+    in the shared state so that the last alternative can raise the most
+    relevant one. Should be considered internal.
+    """
+
+    state: ChooseState
+    active: bool
+    index: int = -1
+
+    def __enter__(self) -> None:
+        self.index = self.state.stream.index
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> bool:
+        state = self.state
+
+        if exc_value is None:
+            state.should_break = True
+            return False
+
+        if self.active:
+            state.stream.index = self.index
+
+        if not isinstance(exc_value, InvalidSyntax):
+            return False
+
+        if exception := state.exception:
+            exception.add_alternative(exc_value)
+            if exc_value.location > exception.location:
+                state.exception = exc_value
+        else:
+            state.exception = exc_value
+
+        if self.active:
+            return True
+
+        raise state.exception from None
+
+
+@dataclass(slots=True)
+class Syntax:
+    """Context manager returned by :meth:`TokenStream.syntax` and :meth:`TokenStream.reset_syntax`.
+
+    Should be considered internal.
+    """
+
+    stream: "TokenStream"
+    rules: Mapping[str, str | None]
+    reset: bool = False
+    previous_syntax: SyntaxRules = field(init=False)
+    previous_regex: "re.Pattern[str]" = field(init=False)
+
+    def __enter__(self) -> None:
+        stream = self.stream
+
+        self.previous_syntax = stream.syntax_rules
+        self.previous_regex = stream.regex
+
+        if self.reset:
+            stream.syntax_rules = ()
+
+        stream.syntax_rules = stream.extend_syntax_rules(self.rules)
+
+        stream.bake_regex()
+        stream.crop()
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> bool:
+        stream = self.stream
+        stream.syntax_rules = self.previous_syntax
+        stream.regex = self.previous_regex
+        stream.crop()
+        return False
+
+
+@dataclass(slots=True)
+class Indentation:
+    """Context manager returned by :meth:`TokenStream.indent`.
+
+    Should be considered internal.
+    """
+
+    stream: "TokenStream"
+    enable: bool
+    skip: Iterable[str] | None
+    previous_indentation: list[int] = field(init=False)
+    previous_history: list[tuple[int, list[int]]] = field(init=False)
+    previous_skip: frozenset[str] = field(init=False)
+
+    def __enter__(self) -> None:
+        stream = self.stream
+        stream.crop()
+
+        self.previous_indentation = stream.indentation
+        self.previous_history = stream.indentation_history
+        stream.indentation = [0] if self.enable else []
+        stream.indentation_history = [(len(stream.tokens), stream.indentation)]
+
+        self.previous_skip = stream.indentation_skip
+        stream.indentation_skip = frozenset(
+            map(intern, self.skip if self.skip is not None else ())
+        ) | {"newline"}
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> bool:
+        self.stream.indentation = self.previous_indentation
+        self.stream.indentation_history = self.previous_history
+        self.stream.indentation_skip = self.previous_skip
+        return False
+
+
+@dataclass(slots=True)
+class IgnoredTokens:
+    """Context manager returned by :meth:`TokenStream.ignore` and :meth:`TokenStream.intercept`.
+
+    Should be considered internal.
+    """
+
+    stream: "TokenStream"
+    token_types: tuple[str, ...]
+    ignore: bool
+    previous_ignored: frozenset[str] = field(init=False)
+
+    def __enter__(self) -> None:
+        stream = self.stream
+        self.previous_ignored = stream.ignored_tokens
+
+        if self.ignore:
+            stream.ignored_tokens = stream.ignored_tokens.union(
+                map(intern, self.token_types)
+            )
+        else:
+            stream.ignored_tokens = stream.ignored_tokens.difference(self.token_types)
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> bool:
+        self.stream.ignored_tokens = self.previous_ignored
+        return False
+
+
+@dataclass(slots=True)
+class Provide:
+    """Context manager returned by :meth:`TokenStream.provide`.
+
+    Should be considered internal.
+    """
+
+    stream: "TokenStream"
+    data: dict[str, Any]
+    previous_data: dict[str, Any] = field(init=False)
+
+    def __enter__(self) -> "TokenStream":
+        data = self.stream.data
+        self.previous_data = {key: data.get(key, MISSING) for key in self.data}
+        data.update(self.data)
+        return self.stream
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> bool:
+        data = self.stream.data
+        for key, value in self.previous_data.items():
+            if value is MISSING:
+                del data[key]
+            else:
+                data[key] = value
+        return False
+
+
+@dataclass(slots=True)
+class Reset:
+    """Context manager returned by :meth:`TokenStream.reset`.
+
+    Should be considered internal.
+    """
+
+    stream: "TokenStream"
+    keys: tuple[str, ...]
+    previous_data: dict[str, Any] = field(init=False)
+
+    def __enter__(self) -> "TokenStream":
+        data = self.stream.data
+        self.previous_data = {key: data.pop(key) for key in self.keys if key in data}
+        return self.stream
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> bool:
+        self.stream.data.update(self.previous_data)
+        return False
+
+
 BAKED_REGEX_CACHE: dict[Any, dict[SyntaxRules, re.Pattern[str]]] = {}
+REGEX_CACHE_SIZE = 512
+
+SYNTAX_RULES_INTERN: dict[SyntaxRules, SyntaxRules] = {}
+SYNTAX_RULES_MERGE_CACHE: dict[Any, tuple[SyntaxRules, SyntaxRules]] = {}
+SYNTAX_RULES_CACHE_SIZE = 1024
+
+MISSING: Any = object()
+
 
+def trim_cache(cache: dict[Any, Any], size: int) -> None:
+    """Discard the oldest entries until the cache has room for a new one.
+
+    The caches are shared between streams so the entries are removed with ``pop()``
+    in case another thread already discarded them. Should be considered internal.
+
+    >>> from tokenstream.stream import trim_cache
+    >>> cache = {"a": 1, "b": 2, "c": 3}
+    >>> trim_cache(cache, 2)
+    >>> cache
+    {'c': 3}
+    """
+    while len(cache) >= size:
+        cache.pop(next(iter(cache), None), None)
 
-@dataclass
-class TokenStream:
+
+@lru_cache(maxsize=256)
+def indentation_level(whitespace: str) -> int:
+    """Return the width of the given indentation, with tabs expanded to 8 columns.
+
+    Source files only use a handful of distinct indentation strings so the result
+    is cached.
+
+    >>> from tokenstream.stream import indentation_level
+    >>> indentation_level("    "), indentation_level("\\t"), indentation_level("  \\t ")
+    (4, 8, 9)
+    """
+    return len(whitespace.expandtabs())
+
+
+class WeakReferenceable:
+    """Base class providing a ``__weakref__`` slot to slotted dataclasses.
+
+    The ``weakref_slot`` dataclass option is only available on Python 3.11+.
+    Should be considered internal.
+    """
+
+    __slots__ = ("__weakref__",)
+
+
+@dataclass(slots=True)
+class TokenStream(WeakReferenceable):
     r"""A versatile token stream for handwritten parsers.
 
     The stream is iterable and will yield all the extracted tokens one after the other.
@@ -116,25 +449,30 @@ class TokenStream:
         try to index into the list directly. Use methods like :meth:`expect`,
         :meth:`peek`, or :meth:`collect` instead.
 
+    shared_tokens
+        Whether the list of extracted tokens is shared with a copy of the stream.
+        The list will be copied before being modified.
+
+        Should be considered internal.
+
     indentation
         A list that keeps track of the indentation levels when indentation is enabled.
         The list is empty when indentation is disabled.
 
+        The list is never modified in place so it can be shared between copies of
+        the stream.
+
     indentation_skip
-        A set of token types for which the token stream shouldn't emit indentation
-        changes.
+        A frozen set of token types for which the token stream shouldn't emit
+        indentation changes.
 
         Can be set using the ``skip`` argument of the :meth:`indent` method.
 
-    generator
-        An instance of the :meth:`generate_tokens` generator that the stream iterates
-        iterates through to extract and emit tokens.
-
-        Should be considered internal.
-
     ignored_tokens
-        A set of token types that the stream skips over when iterating, peeking,
-        and expecting tokens.
+        A frozen set of token types that the stream skips over when iterating,
+        peeking, and expecting tokens. Use the :meth:`ignore` and :meth:`intercept`
+        methods to change it. The set is immutable so it can be shared between
+        copies of the stream.
 
     data
         A dictionary holding arbitrary user data.
@@ -144,9 +482,18 @@ class TokenStream:
         module by default. It's possible to swap it out for https://github.com/mrabarnett/mrab-regex
         by specifying the module as keyword argument when creating a new :class:`TokenStream`.
 
+        Any module following the same interface works, for example a binding to a
+        DFA-based engine like ``re2``. The stream only relies on
+        ``compile(pattern, flags)`` returning an object with a
+        ``match(string, pos)`` method, and on the returned match object
+        exposing ``lastgroup`` and ``group()``. If the module doesn't define a
+        ``MULTILINE`` flag, the pattern enables it inline with ``(?m)`` instead.
+
     regex_cache
         A cache that keeps a reference to the compiled regular expression associated
-        to each set of syntax rules.
+        to each set of syntax rules. The cache is shared by all the streams using the
+        same regex module and holds at most ``REGEX_CACHE_SIZE`` patterns. The oldest
+        patterns are discarded first.
     """
 
     source: str
@@ -165,11 +512,12 @@ class TokenStream:
 
     index: int = extra_field(default=-1)
     tokens: list[Token] = extra_field(default_factory=list)
+    shared_tokens: bool = extra_field(default=False)
     indentation: list[int] = extra_field(default_factory=list)
-    indentation_skip: set[str] = extra_field(default_factory=set)
+    indentation_history: list[tuple[int, list[int]]] = extra_field(default_factory=list)
+    indentation_skip: frozenset[str] = extra_field(default=frozenset())
 
-    generator: Iterator[Token] = extra_field()
-    ignored_tokens: set[str] = extra_field()
+    ignored_tokens: frozenset[str] = extra_field()
 
     data: dict[str, Any] = extra_field(default_factory=dict)
 
@@ -183,11 +531,31 @@ class TokenStream:
         else:
             self.preprocessed_source = self.source
 
-        self.generator = self.generate_tokens()
-        self.ignored_tokens = {"whitespace", "newline", "eof"}
+        self.ignored_tokens = frozenset(("whitespace", "newline", "eof"))
         self.regex_cache = BAKED_REGEX_CACHE.setdefault(self.regex_module, {})
         self.bake_regex()
 
+    @classmethod
+    def precompile(cls, *syntax_rules: SyntaxRules, regex_module: Any = re) -> None:
+        """Compile the regular expressions for the given syntax rules ahead of time.
+
+        The compiled patterns end up in the shared regex cache, so streams using the
+        same rules later on don't have to compile them. This lets you move the cost
+        of compiling the grammar to import time.
+
+        >>> TokenStream.precompile(
+        ...     (("word", r"[a-z]+"),),
+        ...     (("number", r"[0-9]+"), ("word", r"[a-z]+")),
+        ... )
+        >>> (("word", r"[a-z]+"),) in TokenStream("").regex_cache
+        True
+        """
+        stream = cls("", regex_module=regex_module)
+
+        for rules in syntax_rules:
+            stream.syntax_rules = stream.intern_syntax_rules(rules)
+            stream.bake_regex()
+
     def bake_regex(self) -> None:
         """Compile the syntax rules.
 
@@ -198,21 +566,67 @@ class TokenStream:
             self.regex = regex
             return
 
-        self.regex = self.regex_module.compile(
-            "|".join(
-                f"(?P<{name}>{regex})"
-                for name, regex in self.syntax_rules
-                + (
-                    ("newline", r"\r?\n"),
-                    ("whitespace", r"[ \t]+"),
-                    ("invalid", r".+"),
-                )
-            ),
-            self.regex_module.MULTILINE,
+        pattern = "|".join(
+            f"(?P<{name}>{regex})"
+            for name, regex in self.syntax_rules
+            + (
+                ("newline", r"\r?\n"),
+                ("whitespace", r"[ \t]+"),
+                ("invalid", r".+"),
+            )
         )
 
+        if (flags := getattr(self.regex_module, "MULTILINE", None)) is None:
+            pattern, flags = f"(?m){pattern}", 0
+
+        self.regex = self.regex_module.compile(pattern, flags)
+
+        trim_cache(self.regex_cache, REGEX_CACHE_SIZE)
+
         self.regex_cache[self.syntax_rules] = self.regex
 
+    def intern_syntax_rules(self, syntax_rules: SyntaxRules) -> SyntaxRules:
+        """Return a canonical instance of the given syntax rules.
+
+        Equal rules always resolve to the same tuple, which lets the regex cache
+        lookups succeed on identity instead of comparing every pattern.
+        Should be considered internal.
+        """
+        if (interned := SYNTAX_RULES_INTERN.get(syntax_rules)) is not None:
+            return interned
+
+        trim_cache(SYNTAX_RULES_INTERN, SYNTAX_RULES_CACHE_SIZE)
+
+        SYNTAX_RULES_INTERN[syntax_rules] = syntax_rules
+        return syntax_rules
+
+    def extend_syntax_rules(self, rules: Mapping[str, str | None]) -> SyntaxRules:
+        """Merge the given rules with the current syntax rules.
+
+        The result is remembered for each set of current rules, so entering the
+        same nested :meth:`syntax` blocks again only costs a dict lookup.
+        Should be considered internal.
+        """
+        syntax_rules = self.syntax_rules
+        key = (id(syntax_rules), tuple(rules.items()))
+
+        if (entry := SYNTAX_RULES_MERGE_CACHE.get(key)) and entry[0] is syntax_rules:
+            return entry[1]
+
+        merged_rules = dict(rules)
+
+        for name, regex in syntax_rules:
+            merged_rules.setdefault(name, regex)
+
+        extended_rules = self.intern_syntax_rules(
+            tuple((name, regex) for name, regex in merged_rules.items() if regex)
+        )
+
+        trim_cache(SYNTAX_RULES_MERGE_CACHE, SYNTAX_RULES_CACHE_SIZE)
+
+        SYNTAX_RULES_MERGE_CACHE[key] = syntax_rules, extended_rules
+        return extended_rules
+
     def crop(self) -> None:
         """Clear upcoming precomputed tokens.
 
@@ -230,14 +644,42 @@ class TokenStream:
         Mostly used to ensure consistency in some of the provided context managers.
         Should be considered internal.
         """
-        del self.tokens[self.index + 1 :]
-        del self.preprocessed_locations[self.index + 1 :]
-        self.preprocessed_pos, self.preprocessed_lineno, self.preprocessed_colno = (
-            self.preprocessed_locations[self.index] if self.index >= 0 else (0, 1, 1)
-        )
+        if len(self.tokens) > self.index + 1:
+            if self.shared_tokens:
+                self.unshare_tokens()
+            del self.tokens[self.index + 1 :]
+            del self.preprocessed_locations[self.index + 1 :]
+
+            history = self.indentation_history
+            while len(history) > 1 and history[-1][0] > self.index + 1:
+                history.pop()
+                self.indentation = history[-1][1]
+
+        if self.index < 0:
+            location = INITIAL_LOCATION
+        elif self.preprocessed_mappings:
+            location = self.preprocessed_locations[self.index]
+        else:
+            location = self.tokens[self.index].end_location
+
+        (
+            self.preprocessed_pos,
+            self.preprocessed_lineno,
+            self.preprocessed_colno,
+        ) = location
 
-    @contextmanager
-    def syntax(self, **kwargs: str | None) -> Iterator[None]:
+    def unshare_tokens(self) -> None:
+        """Copy the token buffers shared with a copy of the stream.
+
+        Called automatically before modifying the buffers.
+        Should be considered internal.
+        """
+        self.tokens = list(self.tokens)
+        self.preprocessed_locations = list(self.preprocessed_locations)
+        self.indentation_history = list(self.indentation_history)
+        self.shared_tokens = False
+
+    def syntax(self, **kwargs: str | None) -> ContextManager[None]:
         """Extend token syntax using regular expressions.
 
         The keyword arguments associate regular expression patterns to token types. The method returns a context manager during which the specified tokens will be recognized.
@@ -272,28 +714,9 @@ class TokenStream:
         Traceback (most recent call last):
         UnexpectedToken: Expected word but got invalid 'hello world 123'.
         """
-        previous_syntax = self.syntax_rules
-        previous_regex = self.regex
-
-        for key, value in previous_syntax:
-            kwargs.setdefault(key, value)
-
-        self.syntax_rules = tuple(
-            (key, value) for key, value in kwargs.items() if value
-        )
+        return Syntax(self, kwargs)
 
-        self.bake_regex()
-        self.crop()
-
-        try:
-            yield
-        finally:
-            self.syntax_rules = previous_syntax
-            self.regex = previous_regex
-            self.crop()
-
-    @contextmanager
-    def reset_syntax(self, **kwargs: str) -> Iterator[None]:
+    def reset_syntax(self, **kwargs: str) -> ContextManager[None]:
         """Overwrite the existing syntax rules.
 
         This method lets you temporarily overwrite the existing rules instead
@@ -308,21 +731,13 @@ class TokenStream:
         Traceback (most recent call last):
         UnexpectedToken: Expected word but got invalid 'hello world 123'.
         """
-        previous_syntax = self.syntax_rules
-        self.syntax_rules = ()
-
-        try:
-            with self.syntax(**kwargs):
-                yield
-        finally:
-            self.syntax_rules = previous_syntax
+        return Syntax(self, kwargs, reset=True)
 
-    @contextmanager
     def indent(
         self,
         enable: bool = True,
         skip: Iterable[str] | None = None,
-    ) -> Iterator[None]:
+    ) -> ContextManager[None]:
         r"""Enable or disable indentation.
 
         When indentation is enabled the token stream will track the current indentation
@@ -364,22 +779,9 @@ class TokenStream:
             with stream.indent(enable=False):
                 ...
         """
-        previous_indentation = self.indentation
-        self.indentation = [0] if enable else []
-
-        previous_skip = self.indentation_skip
-        self.indentation_skip = set(skip if skip is not None else []) | {"newline"}
-
-        self.crop()
-
-        try:
-            yield
-        finally:
-            self.indentation = previous_indentation
-            self.indentation_skip = previous_skip
+        return Indentation(self, enable, skip)
 
-    @contextmanager
-    def intercept(self, *token_types: str) -> Iterator[None]:
+    def intercept(self, *token_types: str) -> ContextManager[None]:
         r"""Intercept tokens matching the given types.
 
         This tells the stream to not skip over previously ignored tokens
@@ -398,16 +800,9 @@ class TokenStream:
 
         You can use the :meth:`ignore` method to ignore previously intercepted tokens.
         """
-        previous_ignored = self.ignored_tokens
-        self.ignored_tokens = self.ignored_tokens - set(token_types)
+        return IgnoredTokens(self, token_types, ignore=False)
 
-        try:
-            yield
-        finally:
-            self.ignored_tokens = previous_ignored
-
-    @contextmanager
-    def ignore(self, *token_types: str) -> Iterator[None]:
+    def ignore(self, *token_types: str) -> ContextManager[None]:
         """Ignore tokens matching the given types.
 
         This tells the stream to skip over tokens matching any of the given types.
@@ -421,13 +816,7 @@ class TokenStream:
 
         You can use the :meth:`intercept` method to stop ignoring tokens.
         """
-        previous_ignored = self.ignored_tokens
-        self.ignored_tokens = self.ignored_tokens | set(token_types)
-
-        try:
-            yield
-        finally:
-            self.ignored_tokens = previous_ignored
+        return IgnoredTokens(self, token_types, ignore=True)
 
     @property
     def current(self) -> Token:
@@ -461,7 +850,7 @@ class TokenStream:
         'hello'
         ' world'
         """
-        pos = self.current.end_location.pos if self.index >= 0 else 0
+        pos = self.tokens[self.index].end_location.pos if self.index >= 0 else 0
         return self.source[pos:]
 
     def head(self, characters: int = 50) -> str:
@@ -480,14 +869,14 @@ class TokenStream:
         The generated string is truncated to 50 characters by default but you
         can change this with the ``characters`` argument.
         """
-        pos = self.current.end_location.pos if self.index >= 0 else 0
+        pos = self.tokens[self.index].end_location.pos if self.index >= 0 else 0
         value = self.source[pos : pos + characters]
         return value.partition("\n")[0]
 
     def emit_token(self, token_type: str, value: str = "") -> Token:
         """Generate a token in the token stream.
 
-        Should be considered internal. Used by the :meth:`generate_tokens` method.
+        Should be considered internal. Used by the :meth:`extract_tokens` method.
         """
         location = SourceLocation(
             self.preprocessed_pos,
@@ -495,28 +884,32 @@ class TokenStream:
             self.preprocessed_colno,
         )
 
-        end_location = location.skip_over(value)
-
-        (
-            self.preprocessed_pos,
-            self.preprocessed_lineno,
-            self.preprocessed_colno,
-        ) = end_location
-
-        token = Token(
-            type=token_type,
-            value=value,
-            location=location.map(self.preprocessed_mappings, self.source_mappings),
-            end_location=end_location.map(
-                self.preprocessed_mappings, self.source_mappings
-            ),
-        )
+        if value:
+            end_location = location.skip_over(value)
+            (
+                self.preprocessed_pos,
+                self.preprocessed_lineno,
+                self.preprocessed_colno,
+            ) = end_location
+        else:
+            end_location = location
+
+        if self.shared_tokens:
+            self.unshare_tokens()
+
+        if mappings := self.preprocessed_mappings:
+            token = Token(
+                token_type,
+                value,
+                location.map(mappings, self.source_mappings),
+                end_location.map(mappings, self.source_mappings),
+            )
+            self.preprocessed_locations.append(end_location)
+        else:
+            token = Token(token_type, value, location, end_location)
 
-        self.preprocessed_locations.append(end_location)
         self.tokens.append(token)
 
-        self.index = len(self.tokens) - 1
-
         return token
 
     def emit_error(self, exc: T) -> T:
@@ -535,69 +928,108 @@ class TokenStream:
         """
         return set_location(
             exc,
-            self.current.end_location if self.index >= 0 else INITIAL_LOCATION,
+            self.tokens[self.index].end_location
+            if self.index >= 0
+            else INITIAL_LOCATION,
         )
 
-    def generate_tokens(self) -> Iterator[Token]:
-        """Extract tokens from the input string.
+    def extract_tokens(self) -> bool:
+        """Extract the next token from the input string.
 
-        Should be considered internal. This is the underlying generator being driven
-        by the stream.
-        """
-
-        def emit_dedent(level: int = 0) -> Iterator[Token]:
-            while self.indentation and level < self.indentation[-1]:
-                self.emit_token("dedent")
-                self.indentation.pop()
-                yield self.current
+        The token is appended to the list of extracted tokens, along with the
+        ``indent`` and ``dedent`` tokens preceding it if indentation is enabled.
+        Returns ``False`` if there's nothing left to extract.
 
-        while self.preprocessed_pos < len(self.preprocessed_source):
-            match = self.regex.match(self.preprocessed_source, self.preprocessed_pos)
+        Should be considered internal. This is called by the stream when it needs
+        to look past the extracted tokens. Because all the state lives on the stream,
+        extraction can resume after :meth:`crop` even if the stream previously
+        reached the end of the input.
+        """
+        source = self.preprocessed_source
+        pos = self.preprocessed_pos
+        tokens = self.tokens
+
+        if pos >= len(source):
+            if tokens and tokens[-1].type == "eof":
+                return False
+            self.emit_dedent()
+            self.emit_token("eof")
+            return True
+
+        match = self.regex.match(source, pos)
+
+        assert match
+        assert match.lastgroup
+
+        token_type, value = intern(match.lastgroup), match.group()
+
+        if self.indentation and tokens:
+            previous = tokens[-1]
+            previous_type = previous.type
+
+            if previous_type == "indent" or previous_type == "dedent":
+                # After a crop the buffer can end with some of the layout tokens
+                # emitted for the upcoming token. The indentation stack was restored
+                # accordingly so look past them to emit the remaining ones.
+                for previous in reversed(tokens):
+                    previous_type = previous.type
+                    if previous_type != "indent" and previous_type != "dedent":
+                        break
 
-            assert match
-            assert match.lastgroup
+            if previous_type == "newline":
+                if token_type != "whitespace" and token_type != "newline":
+                    self.emit_dedent()
 
-            if self.tokens and self.indentation:
-                if (
-                    self.current.type == "whitespace"
-                    and self.current.location.colno == 1
-                    and match.lastgroup not in self.indentation_skip
-                ):
-                    level = len(self.current.value.expandtabs())
-                    yield from emit_dedent(level)
+            elif (
+                previous_type == "whitespace"
+                and previous.location.colno == 1
+                and token_type not in self.indentation_skip
+            ):
+                level = indentation_level(previous.value)
+                self.emit_dedent(level)
 
-                    if level > self.indentation[-1]:
-                        self.emit_token("indent")
-                        self.indentation.append(level)
-                        yield self.current
+                if level > self.indentation[-1]:
+                    self.emit_token("indent")
+                    self.indentation = self.indentation + [level]
+                    self.indentation_history.append(
+                        (len(self.tokens), self.indentation)
+                    )
 
-                elif self.current.type == "newline" and match.lastgroup not in [
-                    "whitespace",
-                    "newline",
-                ]:
-                    yield from emit_dedent()
+        self.emit_token(token_type, value)
 
-            self.emit_token(match.lastgroup, match.group())
-            yield self.current
+        return True
 
-        yield from emit_dedent()
+    def emit_dedent(self, level: int = 0) -> None:
+        """Emit dedent tokens until the indentation level is lower or equal to the given level.
 
-        self.emit_token("eof")
-        yield self.current
+        Should be considered internal. Used by the :meth:`extract_tokens` method.
+        """
+        while self.indentation and level < self.indentation[-1]:
+            self.emit_token("dedent")
+            self.indentation = self.indentation[:-1]
+            self.indentation_history.append((len(self.tokens), self.indentation))
 
     def __iter__(self) -> "TokenStream":
         return self
 
     def __next__(self) -> Token:
-        if self.index + 1 < len(self.tokens):
-            self.index += 1
-        else:
-            next(self.generator)
+        tokens = self.tokens
+        ignored_tokens = self.ignored_tokens
+        index = self.index
+
+        while True:
+            index += 1
 
-        if self.current.type in self.ignored_tokens:
-            return next(self)
+            if index >= len(tokens):
+                if not self.extract_tokens():
+                    raise StopIteration
+                tokens = self.tokens
 
-        return self.current
+            self.index = index
+            token = tokens[index]
+
+            if token.type not in ignored_tokens:
+                return token
 
     def peek(self, n: int = 1) -> Token | None:
         """Peek around the current token.
@@ -636,28 +1068,34 @@ class TokenStream:
         >>> stream.previous.value
         ' '
         """
-        previous_index = self.index
+        tokens = self.tokens
+        ignored_tokens = self.ignored_tokens
+        index = self.index
         token = None
 
-        try:
-            while n < 0:
-                if self.index <= 0:
-                    return None
-
-                while self.index > 0:
-                    self.index -= 1
-                    if self.current.type not in self.ignored_tokens:
-                        token = self.current
-                        break
-                n += 1
+        while n < 0:
+            if index <= 0:
+                return None
 
-            for _ in range(n):
-                for token in self:
+            while index > 0:
+                index -= 1
+                if tokens[index].type not in ignored_tokens:
+                    token = tokens[index]
                     break
-                else:
+            n += 1
+
+        while n > 0:
+            index += 1
+
+            if index >= len(tokens):
+                if not self.extract_tokens():
                     return None
-        finally:
-            self.index = previous_index
+                tokens = self.tokens
+
+            token = tokens[index]
+
+            if token.type not in ignored_tokens:
+                n -= 1
 
         return token
 
@@ -693,8 +1131,10 @@ class TokenStream:
         ...     print([stream.expect("word").value for _ in stream.peek_until()])
         ['hello', 'world']
         """
+        match = compile_predicate(patterns)
+
         while token := self.peek():
-            if token.match(*patterns):
+            if match(token):
                 next(self)
                 return
             yield token
@@ -773,23 +1213,23 @@ class TokenStream:
         """
         if not patterns:
             for token in self:
-                if token.match("invalid"):
+                if token.type == "invalid":
                     raise UnexpectedToken(token, patterns)
                 yield token
             return
 
-        while token := self.peek():
-            matches = [token if token.match(pattern) else None for pattern in patterns]
+        if len(patterns) == 1:
+            predicate = compile_predicate(patterns)
+            while (token := self.peek()) and predicate(token):
+                next(self)
+                yield token
+            return
 
-            if not any(matches):
-                break
+        match = compile_patterns(patterns)
 
+        while (token := self.peek()) and (matches := match(token)):
             next(self)
-
-            if len(matches) == 1:
-                yield matches[0]
-            else:
-                yield matches
+            yield matches
 
     def collect_any(self, *patterns: TokenPattern) -> Iterator[Token]:
         """Collect tokens matching one of the given patterns.
@@ -811,8 +1251,10 @@ class TokenStream:
         elif len(patterns) == 1:
             yield from self.collect(patterns[0])
         else:
-            for matches in self.collect(patterns[0], patterns[1], *patterns[2:]):
-                yield next(filter(None, matches))
+            match = compile_predicate(patterns)
+            while (token := self.peek()) and match(token):
+                next(self)
+                yield token
 
     @overload
     def expect(self) -> Token:
@@ -877,20 +1319,34 @@ class TokenStream:
         ...         print("number", number.value)
         word hello
         """
-        for result in self.collect(*patterns):
-            return result
+        if not patterns:
+            for token in self.collect():
+                return token
+            raise self.emit_error(UnexpectedEOF())
 
-        if token := self.peek():
-            raise set_location(self.emit_error(UnexpectedToken(token, patterns)), token)
-        else:
+        previous_index = self.index
+
+        if (token := next(self, None)) is None:
+            self.index = previous_index
             raise self.emit_error(UnexpectedEOF(patterns))
 
+        if len(patterns) == 1:
+            if compile_predicate(patterns)(token):
+                return token
+        elif matches := compile_patterns(patterns)(token):
+            return matches
+
+        self.index = previous_index
+        raise set_location(self.emit_error(UnexpectedToken(token, patterns)), token)
+
     def get(self, *patterns: TokenPattern) -> Token | None:
         """Return the next token if it matches any of the given patterns.
 
         The method works a bit like :meth:`expect` but will return ``None``
         instead of raising an exception if none of the given patterns match.
         If there are no more tokens the method will also return ``None``.
+        Prefer it over :meth:`expect` inside :meth:`alternative` when you only
+        need to check the next token, since it doesn't raise and catch an exception.
 
         >>> stream = TokenStream("hello world 123")
         >>> with stream.syntax(word=r"[a-z]+", number=r"[0-9]+"):
@@ -905,8 +1361,17 @@ class TokenStream:
         '123'
         True
         """
-        for result in self.collect(*patterns):
-            return result if isinstance(result, Token) else next(filter(None, result))  # type: ignore
+        if not patterns:
+            for token in self.collect():
+                return token
+            return None
+
+        previous_index = self.index
+
+        if (token := next(self, None)) and compile_predicate(patterns)(token):
+            return token
+
+        self.index = previous_index
         return None
 
     def expect_any(self, *patterns: TokenPattern) -> Token:
@@ -927,9 +1392,17 @@ class TokenStream:
             return self.expect()
         elif len(patterns) == 1:
             return self.expect(patterns[0])
-        else:
-            matches = self.expect(patterns[0], patterns[1], *patterns[2:])
-            return next(filter(None, matches))
+
+        previous_index = self.index
+
+        if (token := next(self, None)) and compile_predicate(patterns)(token):
+            return token
+
+        self.index = previous_index
+
+        if token is None:
+            raise self.emit_error(UnexpectedEOF(patterns))
+        raise set_location(self.emit_error(UnexpectedToken(token, patterns)), token)
 
     def expect_eof(self) -> None:
         """Raise an exception if there is leftover input.
@@ -946,15 +1419,28 @@ class TokenStream:
         Traceback (most recent call last):
         UnexpectedToken: Expected eof but got invalid 'foo'.
         """
-        with self.intercept("eof"):
-            for _ in self.collect("eof"):
+        previous_index = self.index
+
+        while True:
+            if self.index + 1 < len(self.tokens):
+                self.index += 1
+            elif self.extract_tokens():
+                self.index += 1
+            else:
+                self.index = previous_index
+                return
+
+            token = self.tokens[self.index]
+
+            if token.type == "eof":
                 return
 
-        if token := self.peek():
-            raise set_location(self.emit_error(UnexpectedToken(token, ("eof",))), token)
+            if token.type not in self.ignored_tokens:
+                self.index = previous_index
+                exc = UnexpectedToken(token, ("eof",))
+                raise set_location(self.emit_error(exc), token)
 
-    @contextmanager
-    def checkpoint(self) -> Iterator[CheckpointCommit]:
+    def checkpoint(self) -> ContextManager[CheckpointCommit]:
         """Reset the stream to the current token at the end of the ``with`` statement.
 
         >>> stream = TokenStream("hello world")
@@ -981,19 +1467,9 @@ class TokenStream:
         The context manager will swallow syntax errors until the handle
         commits the checkpoint.
         """
-        commit = CheckpointCommit(self.index)
-
-        try:
-            yield commit
-        except InvalidSyntax:
-            if not commit.rollback:
-                raise
-        finally:
-            if commit.rollback:
-                self.index = commit.index
-
-    @contextmanager
-    def alternative(self, active: bool = True) -> Iterator[None]:
+        return Checkpoint(self)
+
+    def alternative(self, active: bool = True) -> ContextManager[None]:
         """Keep going if the code within the ``with`` statement raises a syntax error.
 
         >>> stream = TokenStream("hello world 123")
@@ -1017,12 +1493,7 @@ class TokenStream:
         Traceback (most recent call last):
         UnexpectedToken: Expected number but got word 'hello'.
         """
-        if not active:
-            yield
-            return
-        with self.checkpoint() as commit:
-            yield
-            commit()
+        return Alternative(self, active)
 
     def choose(self, *args: T) -> Iterator[tuple[T, ContextManager[None]]]:
         """Iterate over each argument until one of the alternative succeeds.
@@ -1037,34 +1508,15 @@ class TokenStream:
         'world'
         '123'
         """
-        should_break = False
-        exception: InvalidSyntax | None = None
-
-        @contextmanager
-        def alternative(active: bool):
-            with self.alternative(active):
-                nonlocal should_break, exception
-
-                try:
-                    yield
-                    should_break = True
-
-                except InvalidSyntax as exc:
-                    if exception:
-                        exception.add_alternative(exc)
-                        if exc.location > exception.location:
-                            exception = exc
-                    else:
-                        exception = exc
-                    raise exception from None
+        state = ChooseState(self)
+        last = len(args) - 1
 
         for i, arg in enumerate(args):
-            yield arg, alternative(i < len(args) - 1)
-            if should_break:
+            yield arg, ChooseAlternative(state, i < last)
+            if state.should_break:
                 break
 
-    @contextmanager
-    def provide(self, **data: Any):
+    def provide(self, **data: Any) -> ContextManager["TokenStream"]:
         """Provide arbitrary user data.
 
         >>> stream = TokenStream("hello world")
@@ -1072,25 +1524,9 @@ class TokenStream:
         ...     stream.data["foo"]
         123
         """
-        to_restore: dict[str, Any] = {}
-        to_remove: set[str] = set()
+        return Provide(self, data)
 
-        for key, value in data.items():
-            if key in self.data:
-                to_restore[key] = self.data[key]
-            else:
-                to_remove.add(key)
-            self.data[key] = value
-
-        try:
-            yield self
-        finally:
-            for key in to_remove:
-                del self.data[key]
-            self.data.update(to_restore)
-
-    @contextmanager
-    def reset(self, *args: str):
+    def reset(self, *args: str) -> ContextManager["TokenStream"]:
         """Temporarily reset arbitrary user data.
 
         >>> stream = TokenStream("hello world")
@@ -1103,17 +1539,7 @@ class TokenStream:
         {}
         {'foo': 123}
         """
-        to_restore: dict[str, Any] = {}
-
-        for key in args:
-            if key in self.data:
-                to_restore[key] = self.data[key]
-                del self.data[key]
-
-        try:
-            yield self
-        finally:
-            self.data.update(to_restore)
+        return Reset(self, args)
 
     def copy(self) -> "TokenStream":
         """Return a copy of the stream.
@@ -1129,8 +1555,9 @@ class TokenStream:
         ...     [token.value for token in stream_copy]
         ['w', 'o', 'r', 'l', 'd']
         """
-        copy = TokenStream(self.source, regex_module=self.regex_module)
+        copy = TokenStream.__new__(TokenStream)
 
+        copy.source = self.source
         copy.syntax_rules = self.syntax_rules
         copy.regex = self.regex
 
@@ -1142,15 +1569,20 @@ class TokenStream:
         copy.preprocessed_pos = self.preprocessed_pos
         copy.preprocessed_lineno = self.preprocessed_lineno
         copy.preprocessed_colno = self.preprocessed_colno
-        copy.preprocessed_locations = list(self.preprocessed_locations)
+        copy.preprocessed_locations = self.preprocessed_locations
 
         copy.index = self.index
-        copy.tokens = list(self.tokens)
-        copy.indentation = list(self.indentation)
-        copy.indentation_skip = set(self.indentation_skip)
+        copy.tokens = self.tokens
+        copy.shared_tokens = self.shared_tokens = True
+        copy.indentation = self.indentation
+        copy.indentation_history = self.indentation_history
+        copy.indentation_skip = self.indentation_skip
 
-        copy.ignored_tokens = set(self.ignored_tokens)
+        copy.ignored_tokens = self.ignored_tokens
 
         copy.data = dict(self.data)
 
+        copy.regex_module = self.regex_module
+        copy.regex_cache = self.regex_cache
+
         return copy
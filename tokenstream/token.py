@@ -5,7 +5,8 @@ __all__ = [
 ]
 
 
-from typing import NamedTuple, TypeVar
+from functools import lru_cache, wraps
+from typing import Callable, NamedTuple, Sequence, TypeVar
 
 from .location import SourceLocation, set_location
 
@@ -15,8 +16,43 @@ T = TypeVar("T")
 TokenPattern = str | tuple[str, str]
 
 
+def cache_patterns(
+    func: Callable[[tuple[TokenPattern, ...]], T]
+) -> Callable[[tuple[TokenPattern, ...]], T]:
+    """Cache the result of the decorated function for every tuple of patterns.
+
+    Patterns given as lists aren't hashable. They're converted to tuples before
+    looking up the cache, so they keep working like with :meth:`Token.match`.
+
+    >>> from tokenstream.token import cache_patterns
+    >>> describe = cache_patterns(lambda patterns: repr(patterns))
+    >>> describe(("word", ["word", "hello"]))
+    "('word', ('word', 'hello'))"
+    """
+    cached = lru_cache(maxsize=1024)(func)
+
+    @wraps(func)
+    def wrapper(patterns: tuple[TokenPattern, ...]) -> T:
+        try:
+            return cached(patterns)
+        except TypeError:
+            return cached(
+                tuple(
+                    pattern if isinstance(pattern, str) else tuple(pattern)
+                    for pattern in patterns
+                )
+            )
+
+    return wrapper
+
+
+@cache_patterns
 def explain_patterns(patterns: tuple[TokenPattern, ...]) -> str:
-    """Return a message describing the given patterns."""
+    """Return a message describing the given patterns.
+
+    The result is cached because parsers that backtrack raise errors for the
+    same patterns over and over.
+    """
     token_types = list(
         sorted(
             {
@@ -36,6 +72,82 @@ def explain_patterns(patterns: tuple[TokenPattern, ...]) -> str:
     return ", ".join(head + [f"{before_last} or {last}"])
 
 
+@cache_patterns
+def compile_patterns(
+    patterns: tuple[TokenPattern, ...]
+) -> Callable[["Token"], "list[Token | None] | None"]:
+    """Return a function that matches a token against each of the given patterns.
+
+    The function returns a list of the same size as the patterns where the token
+    is at the index of each pattern that matched, or ``None`` if nothing matched.
+    The function is specialized once for every tuple of patterns.
+
+    >>> match = compile_patterns(("word", "number", ("word", "hello")))
+    >>> token = Token("word", "hello", UNKNOWN_LOCATION, UNKNOWN_LOCATION)
+    >>> [bool(result) for result in match(token)]
+    [True, False, True]
+    >>> token = Token("brace", "(", UNKNOWN_LOCATION, UNKNOWN_LOCATION)
+    >>> match(token) is None
+    True
+    """
+    size = len(patterns)
+    types: dict[str, list[int]] = {}
+    pairs: dict[tuple[str, str], list[int]] = {}
+
+    for i, pattern in enumerate(patterns):
+        if isinstance(pattern, str):
+            types.setdefault(pattern, []).append(i)
+        else:
+            pairs.setdefault((pattern[0], pattern[1]), []).append(i)
+
+    def match(token: Token) -> list[Token | None] | None:
+        indices: Sequence[int] = types.get(token.type, ())
+        if pairs and (token.type, token.value) in pairs:
+            indices = [*indices, *pairs[token.type, token.value]]
+        if not indices:
+            return None
+        matches: list[Token | None] = [None] * size
+        for i in indices:
+            matches[i] = token
+        return matches
+
+    return match
+
+
+@cache_patterns
+def compile_predicate(patterns: tuple[TokenPattern, ...]) -> Callable[["Token"], bool]:
+    """Return a function that checks if a token matches any of the given patterns.
+
+    The function is equivalent to calling :meth:`Token.match` with the given patterns,
+    but the patterns are grouped into sets once for every tuple of patterns so
+    checking a token only takes a set lookup. A single pattern is compared directly.
+
+    >>> match = compile_predicate(("number", ("word", "hello")))
+    >>> match(Token("word", "hello", UNKNOWN_LOCATION, UNKNOWN_LOCATION))
+    True
+    >>> match(Token("word", "world", UNKNOWN_LOCATION, UNKNOWN_LOCATION))
+    False
+    """
+    if len(patterns) == 1:
+        pattern = patterns[0]
+
+        if isinstance(pattern, str):
+            return lambda token: token.type == pattern
+
+        token_type, value = pattern
+        return lambda token: token.type == token_type and token.value == value
+
+    types = frozenset(pattern for pattern in patterns if isinstance(pattern, str))
+    pairs = frozenset(
+        (pattern[0], pattern[1]) for pattern in patterns if not isinstance(pattern, str)
+    )
+
+    if not pairs:
+        return lambda token: token.type in types
+
+    return lambda token: token.type in types or (token.type, token.value) in pairs
+
+
 class Token(NamedTuple):
     """Class representing a token."""
 